@@ -12,12 +12,15 @@ from contextlib import contextmanager
 
 import sqlalchemy
 
-from comma.database.model import Base, Distros, MonitoringSubjects
+from comma.database.model import Base, Distros, MonitoringSubjects, PatchData
 from comma.exceptions import CommaDatabaseError, CommaDataError
 
 
 LOGGER = logging.getLogger(__name__)
 
+# Number of rows to send to the database at once for bulk operations
+BATCH_SIZE = 500
+
 
 class DatabaseDriver:
     """
@@ -88,31 +91,34 @@ class DatabaseDriver:
 
         new_revisions: list of <revision>s to add under this distro_id
         """
+        revs = set(revs)
+
         with self.get_session() as session:
-            revs_to_delete = (
-                session.query(MonitoringSubjects)
+            existing = {
+                rev
+                for (rev,) in session.query(MonitoringSubjects.revision)
                 .filter_by(distroID=distro_id)
-                .filter(~MonitoringSubjects.revision.in_(revs))
+                .all()
+            }
+
+            revs_to_delete = sorted(existing - revs)
+            for rev in revs_to_delete:
+                LOGGER.info("For distro %s, deleting revision: %s", distro_id, rev)
+
+            # This is a bulk delete, so no objects need to be synchronized
+            if revs_to_delete:
+                session.query(MonitoringSubjects).filter_by(distroID=distro_id).filter(
+                    MonitoringSubjects.revision.in_(revs_to_delete)
+                ).delete(synchronize_session=False)
+
+            revs_to_add = sorted(revs - existing)
+            for rev in revs_to_add:
+                LOGGER.info("For distro %s, adding revision: %s", distro_id, rev)
+
+            session.bulk_insert_mappings(
+                MonitoringSubjects,
+                [{"distroID": distro_id, "revision": rev} for rev in revs_to_add],
             )
-            for subject in revs_to_delete:
-                LOGGER.info("For distro %s, deleting revision: %s", distro_id, subject.revision)
-
-            # This is a bulk delete and we close the session immediately after.
-            revs_to_delete.delete(synchronize_session=False)
-
-        with self.get_session() as session:
-            for rev in revs:
-                # Only add if it doesn't already exist. We're dealing
-                # with revisions on the scale of 1, so the number of
-                # queries and inserts here doesn't matter.
-                if (
-                    session.query(MonitoringSubjects)
-                    .filter_by(distroID=distro_id, revision=rev)
-                    .first()
-                    is None
-                ):
-                    LOGGER.info("For distro %s, adding revision: %s", distro_id, rev)
-                    session.add(MonitoringSubjects(distroID=distro_id, revision=rev))
 
     def iter_downstream_targets(
         self,
@@ -207,3 +213,11 @@ class DatabaseDriver:
             return tuple(
                 repo for (repo,) in session.query(MonitoringSubjects.distroID).distinct().all()
             )
+
+    def get_patch_commit_ids(self):
+        """
+        Get the commit IDs of all patches in the database
+        """
+
+        with self.get_session() as session:
+            return {commit_id for (commit_id,) in session.query(PatchData.commitID).all()}
@@ -4,18 +4,19 @@
 ORM models for database objects
 """
 
+import re
 from datetime import datetime
 
-import git
 from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
-from comma.util import format_diffs
-from comma.util.tracking import get_filenames
+from comma.util.tracking import LoggedCommit
 
 
 IGNORED_IN_CMSG = "reported-by:", "signed-off-by:", "reviewed-by:", "acked-by:", "cc:"
+IGNORED_IN_CMSG_RE = re.compile("|".join(re.escape(tag) for tag in IGNORED_IN_CMSG), re.IGNORECASE)
+FIXES_RE = re.compile(r"fixes:\s+(\S+)", re.IGNORECASE)
 
 Base = declarative_base()
 
@@ -55,15 +56,15 @@ class PatchData(Base):
     )
 
     @classmethod
-    def create(cls, commit: git.Commit, paths) -> "PatchData":
+    def create(cls, commit: LoggedCommit) -> "PatchData":
         """
         Create patch object from a commit object
         """
 
         patch = cls(
             commitID=commit.hexsha,
-            author=commit.author.name,
-            authorEmail=commit.author.email,
+            author=commit.author_name,
+            authorEmail=commit.author_email,
             authorTime=datetime.utcfromtimestamp(commit.authored_date),
             commitTime=datetime.utcfromtimestamp(commit.committed_date),
         )
@@ -76,21 +77,19 @@ class PatchData(Base):
                 patch.subject = line
                 continue
 
-            if line.lower().startswith(IGNORED_IN_CMSG):
+            if IGNORED_IN_CMSG_RE.match(line):
                 continue
 
             description.append(line)
 
             # Check if this patch fixes other patches
-            if line.lower().startswith("fixes:"):
-                words = line.split(" ")
-                if len(words) > 1:
-                    fixed_patches.append(words[1])
+            if fixes := FIXES_RE.match(line):
+                fixed_patches.append(fixes[1])
 
         patch.description = "\n".join(description)
         patch.fixedPatches = " ".join(fixed_patches)  # e.g. "SHA1 SHA2 SHA3"
-        patch.affectedFilenames = " ".join(get_filenames(commit))
-        patch.commitDiffs = format_diffs(commit, paths)
+        patch.affectedFilenames = " ".join(commit.filenames)
+        patch.commitDiffs = commit.diffs
 
         return patch
 
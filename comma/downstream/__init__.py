@@ -5,7 +5,12 @@ Operations for downstream targets
 """
 
 import logging
+import re
+from typing import Dict, Iterable, List, Tuple
 
+from sqlalchemy import func
+
+from comma.database.driver import BATCH_SIZE
 from comma.database.model import (
     Distros,
     MonitoringSubjects,
@@ -17,6 +22,48 @@ from comma.downstream.matcher import patch_matches
 
 LOGGER = logging.getLogger(__name__.split(".", 1)[0])
 
+# Azure kernel tags, excluding edge, CVM, and FDE variants
+UBUNTU_AZURE_TAG_RE = re.compile(r"^(?!.*(?:edge|cvm|fde)).*azure")
+
+# Upstream patch columns needed for matching
+MATCHED_COLUMNS = (
+    PatchData.patchID,
+    PatchData.commitID,
+    PatchData.subject,
+    PatchData.description,
+    PatchData.author,
+    PatchData.authorTime,
+    PatchData.commitTime,
+    PatchData.affectedFilenames,
+    PatchData.commitDiffs,
+)
+
+
+def get_references(subject: MonitoringSubjects) -> Tuple[str, str]:
+    """
+    Get the local and remote references for a monitoring subject
+    """
+
+    # Use distro name for local refs to prevent duplicates
+    if subject.revision.startswith(f"{subject.distroID}/"):
+        return subject.revision, subject.revision.split("/", 1)[-1]
+
+    return f"{subject.distroID}/{subject.revision}", subject.revision
+
+
+def group_subjects(
+    subjects: Iterable[MonitoringSubjects],
+) -> Dict[str, List[Tuple[int, MonitoringSubjects]]]:
+    """
+    Group monitoring subjects by remote, keeping their position in the original order
+    """
+
+    grouped = {}
+    for num, subject in enumerate(subjects, 1):
+        grouped.setdefault(subject.distroID, []).append((num, subject))
+
+    return grouped
+
 
 class Downstream:
     """
@@ -61,57 +108,83 @@ class Downstream:
             if not total:
                 LOGGER.warning("No downstream targets defined")
 
-            for num, subject in enumerate(subjects, 1):
-                if subject.distroID.startswith("Debian"):
-                    # TODO (Issue 51): Don't skip Debian
-                    LOGGER.info("(%d of %d) Skipping %s", num, total, subject.distroID)
+            # Tracked paths are the same for every subject
+            paths = repo.get_tracked_paths(self.config.upstream.sections)
+
+            for distro_id, numbered_subjects in group_subjects(subjects).items():
+                # TODO (Issue 51): Don't skip Debian
+                if distro_id.startswith("Debian"):
+                    for num, _ in numbered_subjects:
+                        LOGGER.info("(%d of %d) Skipping %s", num, total, distro_id)
                     continue
 
-                # Use distro name for local refs to prevent duplicates
-                if subject.revision.startswith(f"{subject.distroID}/"):
-                    local_ref = subject.revision
-                    remote_ref = subject.revision.split("/", 1)[-1]
-                else:
-                    local_ref = f"{subject.distroID}/{subject.revision}"
-                    remote_ref = subject.revision
-
-                LOGGER.info(
-                    "(%d of %d) Fetching remote ref %s from remote %s",
-                    num,
-                    total,
-                    remote_ref,
-                    subject.distroID,
-                )
-                repo.fetch_remote_ref(
-                    subject.distroID, local_ref, remote_ref, since=self.config.downstream_since
-                )
+                references = self.fetch_subjects(distro_id, numbered_subjects, total)
 
-                LOGGER.info(
-                    "(%d of %d) Monitoring Script starting for distro: %s, revision: %s",
-                    num,
-                    total,
-                    subject.distroID,
-                    remote_ref,
-                )
-                self.monitor_subject(subject, local_ref)
+                for (num, subject), (local_ref, remote_ref) in zip(numbered_subjects, references):
+                    LOGGER.info(
+                        "(%d of %d) Monitoring Script starting for distro: %s, revision: %s",
+                        num,
+                        total,
+                        distro_id,
+                        remote_ref,
+                    )
+                    self.monitor_subject(subject, local_ref, paths)
+
+    def fetch_subjects(
+        self,
+        distro_id: str,
+        numbered_subjects: List[Tuple[int, MonitoringSubjects]],
+        total: int,
+    ) -> List[Tuple[str, str]]:
+        """
+        Fetch the references for subjects of a single remote
+        Returns the local and remote references for each subject
 
-    def monitor_subject(self, monitoring_subject, reference: str):
+        Remote references are looked up with a single request right before fetching,
+        so they are current when compared against the local references
+        """
+
+        references = [get_references(subject) for _, subject in numbered_subjects]
+        remote_shas = self.repo.get_remote_shas(
+            distro_id, (remote_ref for _, remote_ref in references)
+        )
+
+        for (num, _), (local_ref, remote_ref) in zip(numbered_subjects, references):
+            LOGGER.info(
+                "(%d of %d) Fetching remote ref %s from remote %s",
+                num,
+                total,
+                remote_ref,
+                distro_id,
+            )
+            self.repo.fetch_remote_ref(
+                distro_id,
+                local_ref,
+                remote_ref,
+                since=self.config.downstream_since,
+                remote_shas=remote_shas,
+            )
+
+        return references
+
+    def monitor_subject(self, monitoring_subject, reference: str, paths: Tuple[str, ...]):
         """
         Update the missing patches in the database for this monitoring_subject
 
         monitoring_subject: The MonitoringSubject we are updating
         reference: Git reference to monitor
+        paths: Tracked paths
         """
 
         missing_cherries = self.repo.get_missing_cherries(
             reference,
-            self.repo.get_tracked_paths(self.config.upstream.sections),
+            paths,
             since=self.config.upstream_since,
         )
         LOGGER.debug("Found %d missing patches through cherry-pick.", len(missing_cherries))
 
         # Run extra checks on these missing commits
-        missing_patch_ids = self.get_missing_patch_ids(missing_cherries, reference)
+        missing_patch_ids = self.get_missing_patch_ids(missing_cherries, reference, paths)
         LOGGER.info("Identified %d missing patches", len(missing_patch_ids))
 
         # Delete patches that are no longer missing.
@@ -133,63 +206,59 @@ class Downstream:
 
         # Add patches which are newly missing.
         with self.database.get_session() as session:
-            patches = session.query(MonitoringSubjectsMissingPatches).filter_by(
-                monitoringSubjectID=subject_id
-            )
-            new_missing_patches = 0
-            for patch_id in missing_patch_ids:
-                # Only add if it doesn't already exist. We're dealing with patches on the scale
-                # of 100, so the number of queries and inserts here doesn't matter.
-                if patches.filter_by(patchID=patch_id).first() is None:
-                    new_missing_patches += 1
-                    session.add(
-                        MonitoringSubjectsMissingPatches(
-                            monitoringSubjectID=subject_id, patchID=patch_id
-                        )
-                    )
-            LOGGER.info("Adding %d patches that are now missing.", new_missing_patches)
+            existing = {
+                patch_id
+                for (patch_id,) in session.query(MonitoringSubjectsMissingPatches.patchID)
+                .filter_by(monitoringSubjectID=subject_id)
+                .all()
+            }
+            new_missing_patches = [
+                {"monitoringSubjectID": subject_id, "patchID": patch_id}
+                for patch_id in missing_patch_ids
+                if patch_id not in existing
+            ]
+            LOGGER.info("Adding %d patches that are now missing.", len(new_missing_patches))
+            session.bulk_insert_mappings(MonitoringSubjectsMissingPatches, new_missing_patches)
 
-    def get_missing_patch_ids(self, missing_cherries, reference):
+    def get_missing_patch_ids(self, missing_cherries, reference, paths: Tuple[str, ...]):
         """
         Attempt to determine which patches are missing from a list of missing cherries
         """
 
-        paths = self.repo.get_tracked_paths(self.config.upstream.sections)
-
         with self.database.get_session() as session:
-            patches = (
-                session.query(PatchData)
+            # We only want to check downstream patches as old as the oldest upstream missing patch
+            earliest_commit_time, total = (
+                session.query(func.min(PatchData.commitTime), func.count(PatchData.patchID))
                 .filter(PatchData.commitID.in_(missing_cherries))
-                .order_by(PatchData.commitTime)
-                .all()
+                .one()
             )
-            if not patches:
+            if not total:
                 return []
 
-            # We only want to check downstream patches as old as the oldest upstream missing patch
-            earliest_commit_date = min(patch.commitTime for patch in patches).isoformat()
+            earliest_commit_date = earliest_commit_time.isoformat()
             LOGGER.debug("Processing commits since %s", earliest_commit_date)
 
             # Get the downstream commits for this revision (these are distinct from upstream because
             # they have been cherry-picked). This is slow but necessary!
 
             LOGGER.info("Determining downstream commits from tracked files")
-            # We use `--min-parents=1 --max-parents=1` to avoid both merges and graft commits
             downstream_patches = tuple(
-                PatchData.create(commit, paths)
-                for commit in self.repo.iter_commits(
-                    rev=reference,
-                    paths=paths,
-                    min_parents=1,
-                    max_parents=1,
-                    since=earliest_commit_date,
+                PatchData.create(commit)
+                for commit in self.repo.iter_log(
+                    rev=reference, paths=paths, since=earliest_commit_date
                 )
             )
 
             # Double check the missing cherries using our fuzzy algorithm.
-            LOGGER.info("Starting confidence matching for %d upstream patches...", len(patches))
+            # Only columns used for matching are loaded and rows are streamed in batches
+            LOGGER.info("Starting confidence matching for %d upstream patches...", total)
             missing_patches = [
-                p.patchID for p in patches if not patch_matches(downstream_patches, p)
+                patch.patchID
+                for patch in session.query(*MATCHED_COLUMNS)
+                .filter(PatchData.commitID.in_(missing_cherries))
+                .order_by(PatchData.commitTime)
+                .yield_per(BATCH_SIZE)
+                if not patch_matches(downstream_patches, patch)
             ]
 
         return missing_patches
@@ -209,6 +278,6 @@ class Downstream:
             tag_names = tuple(
                 tag
                 for tag in self.repo.get_remote_tags(distro_id)
-                if "azure" in tag and all(label not in tag for label in ("edge", "cvm", "fde"))
+                if UBUNTU_AZURE_TAG_RE.search(tag)
             )
             self.database.update_revisions_for_distro(distro_id, tag_names[-2:])
@@ -6,6 +6,7 @@ Functions for parsing commit objects into patch objects
 
 import logging
 
+from comma.database.driver import BATCH_SIZE
 from comma.database.model import PatchData
 
 
@@ -32,33 +33,36 @@ class Upstream:
         updated = 0
         total = 0
 
-        # We use `--min-parents=1 --max-parents=1` to avoid both merges and graft commits.
+        # Check for existing patches in memory rather than querying for each commit
+        existing = self.database.get_patch_commit_ids()
+        pending = []
+
         LOGGER.info("Determining upstream commits from tracked files")
-        for commit in self.repo.iter_commits(
-            rev=f"origin/{self.config.upstream.reference}",
-            paths=paths,
-            min_parents=1,
-            max_parents=1,
-            since=self.config.upstream_since,
-        ):
-            total += 1
-            with self.database.get_session() as session:
-                # Query database for commit
-                if force_update:
-                    query = session.query(PatchData)
-                else:
-                    query = session.query(PatchData.commitID)
-                patch = query.filter_by(commitID=commit.hexsha).one_or_none()
+        with self.database.get_session() as session:
+            for commit in self.repo.iter_log(
+                rev=f"origin/{self.config.upstream.reference}",
+                paths=paths,
+                since=self.config.upstream_since,
+            ):
+                total += 1
 
                 # If commit is missing, add it
-                if patch is None:
-                    session.add(PatchData.create(commit, paths))
+                if commit.hexsha not in existing:
+                    pending.append(PatchData.create(commit))
                     added += 1
 
+                    # Insert new patches in batches
+                    if len(pending) >= BATCH_SIZE:
+                        session.bulk_save_objects(pending)
+                        session.commit()
+                        pending.clear()
+
                 # If commit is present, optionally update
                 elif force_update:
+                    patch = session.query(PatchData).filter_by(commitID=commit.hexsha).one()
+
                     # Get a local patch object
-                    patch_data = PatchData.create(commit, paths)
+                    patch_data = PatchData.create(commit)
 
                     # Iterate through the columns
                     record_updated = False
@@ -79,6 +83,9 @@ class Upstream:
                     if record_updated:
                         updated += 1
 
+            # Remaining patches are committed when the session closes
+            session.bulk_save_objects(pending)
+
         LOGGER.info("%d of %d patches added to database.", added, total)
         if force_update:
             LOGGER.info("%d of %d patches updated in database.", updated, total)
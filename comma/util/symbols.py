@@ -6,9 +6,11 @@ Functions for generating symbol maps
 
 import logging
 import subprocess
+import tempfile
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Tuple
 
+from comma.database.driver import BATCH_SIZE
 from comma.database.model import PatchData
 
 
@@ -21,20 +23,32 @@ def get_symbols(repo_dir, files):
     files: iterable of files
     returns set of symbols generated through ctags
     """
-    command = "ctags -R -x −−c−kinds=f {}".format(
-        " ".join(files) + " | awk '{ if ($2 == \"function\") print $1 }'"
+
+    # Expand patterns and drop paths missing at this revision, the shell used to do this for us
+    root = Path(repo_dir)
+    paths = sorted(
+        {str(path.relative_to(root)) for file in files for path in root.glob(file.rstrip("/"))}
     )
+    if not paths:
+        return set()
+
+    command = ["ctags", "-R", "-x", "--c-kinds=f", *paths]
     LOGGER.debug("Running command: %s", command)
     process = subprocess.run(
         command,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        shell=True,
         cwd=repo_dir,
         check=True,
         universal_newlines=True,
     )
-    return set(process.stdout.splitlines())
+
+    # Cross reference lines are in the form "name kind line file text"
+    return {
+        fields[0]
+        for fields in (line.split(maxsplit=2) for line in process.stdout.splitlines())
+        if len(fields) > 1 and fields[1] == "function"
+    }
 
 
 class Symbols:
@@ -61,66 +75,72 @@ class Symbols:
         """
 
         with self.database.get_session() as session:
-            # SQLAlchemy returns tuples which need to be unwrapped
-            self.map_symbols_to_patch(
-                [
-                    commit[0]
-                    for commit in session.query(PatchData.commitID)
-                    .order_by(PatchData.commitTime)
-                    .all()
-                ],
-                self.repo.get_tracked_paths(self.config.upstream.sections),
+            patches = (
+                session.query(PatchData.patchID, PatchData.commitID)
+                .order_by(PatchData.commitTime)
+                .all()
             )
 
+        self.map_symbols_to_patch(
+            patches, self.repo.get_tracked_paths(self.config.upstream.sections)
+        )
+
     # TODO (Issue 65): Avoid hard-coding commit ID
     def map_symbols_to_patch(
-        self, commits: Iterable[str], paths, prev_commit="097c1bd5673edaf2a162724636858b71f658fdd2"
+        self,
+        patches: Iterable[Tuple[int, str]],
+        paths,
+        prev_commit="097c1bd5673edaf2a162724636858b71f658fdd2",
     ):
         """
         This function generates and stores symbols generated by each patch
-        repo: git repo object
-        files: hyperV files
-        commits: SHA of all commits in database
+        patches: patch ID and commit SHA pairs of all commits in database
+        paths: hyperV files
         prev_commit: SHA of start of HyperV patch to track
         """
 
         LOGGER.info("Mapping symbols to commits")
 
-        # Preserve initial reference
-        initial_reference = self.repo.head.reference
-
-        try:
-            self.repo.checkout(prev_commit)
-            before_patch_apply = None
+        before_patch_apply = None
+        updates = []
 
+        with self.database.get_session() as session:
             # Iterate through commits
-            for commit in commits:
+            for patch_id, commit in patches:
                 # Get symbols before patch is applied
                 if before_patch_apply is None:
-                    before_patch_apply = get_symbols(self.repo.working_tree_dir, paths)
-
-                # Checkout commit
-                self.repo.checkout(commit)
+                    before_patch_apply = self.get_symbols_at(prev_commit, paths)
 
                 # Get symbols after patch is applied
-                after_patch_apply = get_symbols(self.repo.working_tree_dir, paths)
+                after_patch_apply = self.get_symbols_at(commit, paths)
 
                 # Compare symbols before and after patch
                 diff_symbols = after_patch_apply - before_patch_apply
                 if diff_symbols:
                     print(f"Commit: {commit} -> {' '.join(diff_symbols)}")
 
-                # Save symbols to database
-                with self.database.get_session() as session:
-                    patch = session.query(PatchData).filter_by(commitID=commit).one()
-                    patch.symbols = " ".join(diff_symbols)
+                # Save symbols to database in batches
+                updates.append({"patchID": patch_id, "symbols": " ".join(diff_symbols)})
+                if len(updates) >= BATCH_SIZE:
+                    session.bulk_update_mappings(PatchData, updates)
+                    session.commit()
+                    updates.clear()
 
                 # Use symbols from current commit to compare to next commit
                 before_patch_apply = after_patch_apply
 
-        finally:
-            # Reset reference
-            self.repo.checkout(initial_reference)
+            # Remaining updates are committed when the session closes
+            session.bulk_update_mappings(PatchData, updates)
+
+    def get_symbols_at(self, reference, paths):
+        """
+        Returns a set of symbols for the given paths at the given reference
+        Only the tracked paths are extracted, so the working tree is left untouched
+        """
+
+        with tempfile.TemporaryDirectory(prefix="CommA_") as directory:
+            self.repo.archive_paths(reference, paths, directory)
+            return get_symbols(directory, paths)
 
     def symbol_checker(self, file_path: Path):
         """
@@ -129,14 +149,14 @@ class Symbols:
         returns sorted list of commits whose symbols are missing from file
         """
         with open(file_path, "r", encoding="utf-8") as symbol_file:
-            symbols_in_file = {line.strip() for line in symbol_file}
+            symbols_in_file = frozenset(line.strip() for line in symbol_file)
 
+        # Patches without symbols are stored as empty strings
         with self.database.get_session() as session:
             return sorted(
                 commitID
                 for commitID, symbols in session.query(PatchData.commitID, PatchData.symbols)
-                .filter(PatchData.symbols != " ")
-                .order_by(PatchData.commitTime)
+                .filter(PatchData.symbols != "")
                 .all()
-                if len(set(symbols.split(" ")) - symbols_in_file) > 0
+                if not symbols_in_file.issuperset(symbols.split())
             )
@@ -4,10 +4,13 @@
 Functions and classes for fetching and parsing data from Git
 """
 
+import fnmatch
+import itertools
 import logging
 import pathlib
 import re
-from typing import Any, Iterable, List, Optional, Set, Tuple
+import tarfile
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
 from urllib.parse import urlparse
 
 import git
@@ -62,21 +65,185 @@ class GitRetry:
         raise RuntimeError("Unexpectedly exited loop!")
 
 
-def get_filenames(commit: git.Commit) -> List[str]:
+# Each commit starts with SOH and fields are NUL-separated so output can be parsed as a stream
+LOG_FORMAT = "%x01%H%x00%an%x00%ae%x00%at%x00%ct%x00%B%x00"
+LOG_FIELDS = 6
+
+# Characters with special meaning in pathspecs
+GLOB_CHARS_RE = re.compile(r"[*?[]")
+
+
+class LoggedCommit(NamedTuple):
+    """
+    Commit data parsed from git log output
+    """
+
+    hexsha: str
+    author_name: str
+    author_email: str
+    authored_date: int
+    committed_date: int
+    message: str
+    filenames: Tuple[str, ...]
+    diffs: str
+
+
+def matches_paths(path: str, paths: Iterable[str]) -> bool:
     """
-    Get all paths affected by a given commit
+    Check if a file path is selected by any of the given pathspecs
     """
 
-    if not commit.parents:
-        return []
-    diffs = commit.tree.diff(commit.parents[0])
-    # Sometimes a path is in A and not B but we want all filenames.
-    return sorted(
-        {diff.a_path for diff in diffs if diff.a_path is not None}
-        | {diff.b_path for diff in diffs if diff.b_path is not None}
+    return any(
+        path == pathspec or path.startswith(f"{pathspec}/") or fnmatch.fnmatchcase(path, pathspec)
+        for pathspec in (pathspec.rstrip("/") for pathspec in paths)
     )
 
 
+class FileDiff:
+    """
+    Paths and changed lines for a single file in a patch
+    A path is None when the file doesn't exist on that side
+    """
+
+    def __init__(self, path: Optional[str]) -> None:
+        self.commit_path = path
+        self.parent_path = path
+        self.lines: List[bytes] = []
+
+    def get_paths(self) -> Set[str]:
+        """
+        Get the paths of the file on the sides where it exists
+        """
+
+        return {path for path in (self.commit_path, self.parent_path) if path is not None}
+
+
+class LogParser:
+    """
+    Incremental parser for git log output generated with LOG_FORMAT
+
+    Patches are expected to be reversed and without prefixes, so the first path for each file
+    is the commit's side. This matches the direction of the diffs stored in the database.
+    All affected filenames are collected, but diffs are only kept for the given paths.
+    """
+
+    def __init__(self, paths: Iterable[str]) -> None:
+        self.paths = paths
+        self._header = b""
+        self._fields: Optional[List[str]] = None
+        self._filenames: Set[str] = set()
+        self._diffs: List[str] = []
+        self._file: Optional[FileDiff] = None
+        self._in_hunk = False
+
+    def parse(self, lines: Iterable[bytes]) -> Iterator[LoggedCommit]:
+        """
+        Parse lines of output, yielding each commit once it is complete
+        """
+
+        for line in lines:
+            if line.startswith(b"\x01"):
+                if self._fields is not None:
+                    yield self._finish_commit()
+                self._header = line[1:]
+            elif self._fields is None:
+                self._header += line
+            else:
+                self._parse_diff_line(line)
+                continue
+
+            # The message may span multiple lines, so wait until all fields are read
+            if self._header.count(b"\x00") >= LOG_FIELDS:
+                self._fields = self._header.decode("utf-8", "replace").split("\x00")[:LOG_FIELDS]
+                self._header = b""
+
+        if self._fields is not None:
+            yield self._finish_commit()
+
+    def _parse_diff_line(self, line: bytes) -> None:
+        """
+        Parse a single line of patch output
+        """
+
+        if line.startswith(b"diff --git "):
+            self._finish_file()
+
+            # Paths are only unambiguous here when both sides are the same
+            # Otherwise, they are determined from the rename lines that follow
+            names = line[11:].rstrip(b"\n")
+            mid = (len(names) - 1) // 2
+            half = names[:mid]
+            path = half.decode("utf-8", "replace") if names == half + b" " + half else None
+            self._file = FileDiff(path)
+
+        # Blank lines between the commit message and the first diff
+        elif self._file is None:
+            return
+
+        elif self._in_hunk:
+            if line.startswith((b"+", b"-")):
+                self._file.lines.append(line.rstrip(b"\r\n"))
+
+        elif line.startswith(b"rename from "):
+            self._file.commit_path = line[12:].rstrip(b"\n").decode("utf-8", "replace")
+
+        elif line.startswith(b"rename to "):
+            self._file.parent_path = line[10:].rstrip(b"\n").decode("utf-8", "replace")
+
+        # Patches are reversed, so a new file is one the commit deleted
+        elif line.startswith(b"new file mode"):
+            self._file.commit_path = None
+
+        elif line.startswith(b"deleted file mode"):
+            self._file.parent_path = None
+
+        elif line.startswith(b"@@"):
+            self._in_hunk = True
+
+    def _finish_file(self) -> None:
+        """
+        Store data for the current file
+        """
+
+        if self._file is None:
+            return
+
+        commit_path = self._file.commit_path
+        self._filenames.update(self._file.get_paths())
+
+        # The patch commit diffs are stored as "(filename1)\n(diff1)\n(filename2)\n(diff2)..."
+        if commit_path is not None and matches_paths(commit_path, self.paths):
+            diff = b"\n".join(self._file.lines).decode("utf-8", "replace")
+            self._diffs.append(f"{commit_path}\n{diff}")
+
+        self._file = None
+        self._in_hunk = False
+
+    def _finish_commit(self) -> LoggedCommit:
+        """
+        Create a commit object from the collected data and reset for the next commit
+        """
+
+        self._finish_file()
+        hexsha, author_name, author_email, authored_date, committed_date, message = self._fields
+        commit = LoggedCommit(
+            hexsha=hexsha,
+            author_name=author_name,
+            author_email=author_email,
+            authored_date=int(authored_date),
+            committed_date=int(committed_date),
+            message=message,
+            filenames=tuple(sorted(self._filenames)),
+            diffs="\n".join(self._diffs),
+        )
+
+        self._fields = None
+        self._filenames = set()
+        self._diffs = []
+
+        return commit
+
+
 class Repo:
     """
     Common repository operations
@@ -89,6 +256,7 @@ class Repo:
         self.path = path = pathlib.Path("Repos", name).resolve()
         self.obj: Optional[git.Repo] = git.Repo(path) if path.exists() else None
         self._tracked_paths: Optional[tuple] = None
+        self._remote_tags: Dict[str, Dict[str, str]] = {}
         self.default_ref = default_ref
 
     def __getattr__(self, name: str) -> Any:
@@ -165,8 +333,10 @@ class Repo:
         ]
         refs.append(f"origin/{self.default_ref}")  # Include default reference
 
+        # Blobs are read through the persistent cat-file process rather than a git fork per ref
         for ref in refs:
-            paths |= extract_paths(sections, self.obj.git.show(f"{ref}:MAINTAINERS"))
+            maintainers = self.obj.rev_parse(f"{ref}:MAINTAINERS").data_stream.read()
+            paths |= extract_paths(sections, maintainers.decode("utf-8", errors="replace"))
 
         LOGGER.debug("Completed parsing MAINTAINERS file for %s", self.name)
         self._tracked_paths = tuple(sorted(paths))
@@ -174,10 +344,16 @@ class Repo:
         return self._tracked_paths
 
     def fetch_remote_ref(
-        self, remote: str, local_ref: str, remote_ref: str, since: Optional[DateString] = None
+        self,
+        remote: str,
+        local_ref: str,
+        remote_ref: str,
+        since: Optional[DateString] = None,
+        remote_shas: Optional[Dict[str, str]] = None,
     ) -> None:
         """
         Shallow fetch remote reference so it is available locally
+        remote_shas: Result of get_remote_shas() if the remote reference was already looked up
         """
 
         local_sha = None
@@ -199,8 +375,9 @@ class Repo:
             kwargs["negotiation_tip"] = local_ref
 
             # Get remote ref so we can check against the local ref
-            if output := self.obj.git.ls_remote(remote, remote_ref):
-                remote_sha = output.split()[0]
+            if remote_shas is None:
+                remote_shas = self.get_remote_shas(remote.name, (remote_ref,))
+            remote_sha = remote_shas.get(remote_ref)
 
         # No fetch window specified
         # Or using Azure DevOps since it doesn't support shallow-since or unshallow
@@ -259,6 +436,16 @@ class Repo:
         if local_sha is None or local_sha != remote_sha:
             self.obj.create_tag(local_ref, "FETCH_HEAD", force=True)
 
+    def iter_log_lines(self, *args: str) -> Iterator[str]:
+        """
+        Iterate through lines of git log output as they are produced
+        """
+
+        process = self.obj.git.log(*args, as_process=True)
+        for line in process.stdout:
+            yield line.decode("utf-8", "replace").rstrip("\n")
+        process.wait()
+
     def get_missing_cherries(self, reference, paths, since: Optional[str] = None):
         """
         Get a list of cherry-picked commits missing from the downstream reference
@@ -270,37 +457,140 @@ class Repo:
 
         # Get all upstream commits on tracked paths within window
         upstream_commits = set(
-            self.obj.git.log(
-                *args,
-                f"origin/{self.default_ref}",
-                "--",
-                paths,
-            ).splitlines()
+            self.iter_log_lines(*args, f"origin/{self.default_ref}", "--", *paths)
         )
 
+        # Nothing upstream in the window means nothing can be missing
+        if not upstream_commits:
+            return set()
+
         # Get missing cherries for all paths, but don't filter by path since it takes forever
         missing_cherries = set(
-            self.obj.git.log(
+            self.iter_log_lines(
                 *args,
                 "--right-only",
                 "--cherry-pick",
                 f"{reference}...origin/{self.default_ref}",
-            ).splitlines()
+            )
         )
 
         return missing_cherries & upstream_commits
 
+    def iter_log(
+        self, rev: str, paths: Iterable[str], since: Optional[str] = None
+    ) -> Iterator[LoggedCommit]:
+        """
+        Iterate through commits affecting the given paths
+        Commits are parsed from a single streamed git log rather than being diffed individually
+        """
+
+        # We use `--min-parents=1 --max-parents=1` to avoid both merges and graft commits
+        # Full diffs are needed to list all affected files, LogParser filters them by path
+        args = [
+            "--min-parents=1",
+            "--max-parents=1",
+            f"--format={LOG_FORMAT}",
+            "--patch",
+            "--full-diff",
+            "--find-renames",
+            "-R",
+            "--no-prefix",
+            "--no-color",
+            "--no-ext-diff",
+        ]
+        if since:
+            args.append(f"--since={since}")
+
+        process = self.obj.git(c="core.quotePath=false").log(
+            *args, rev, "--", *paths, as_process=True
+        )
+        yield from LogParser(paths).parse(process.stdout)
+        process.wait()
+
+    def get_remote_shas(self, remote: str, refs: Iterable[str]) -> Dict[str, str]:
+        """
+        Get the SHAs for the given references on a remote with a single request
+        Tags already listed by get_remote_tags() are reused without a request
+        References not found on the remote are omitted
+        """
+
+        known_tags = self._remote_tags.get(remote, {})
+        shas = {}
+        unknown = []
+        for ref in refs:
+            if ref in known_tags:
+                shas[ref] = known_tags[ref]
+            else:
+                unknown.append(ref)
+
+        if not unknown:
+            return shas
+        for line in self.obj.git.ls_remote(remote, *unknown).splitlines():
+            sha, name = line.split()
+            for ref in unknown:
+                # Patterns match the end of the full reference name, first match is used
+                if name == ref or name.endswith(f"/{ref}"):
+                    shas.setdefault(ref, sha)
+
+        return shas
+
     def get_remote_tags(self, remote: str):
         """
         List tags for a given remote in the format tags/TAGNAME
         """
 
-        return tuple(
-            line.split("/", 1)[-1]
-            for line in self.obj.git.ls_remote(
-                "--tags", "--refs", "--sort=v:refname", remote
-            ).splitlines()
+        tags = {}
+        for line in self.obj.git.ls_remote(
+            "--tags", "--refs", "--sort=v:refname", remote
+        ).splitlines():
+            sha, name = line.split()
+            tags[name.split("/", 1)[-1]] = sha
+
+        # Keep SHAs so references don't need to be requested from the remote again
+        self._remote_tags[remote] = tags
+
+        return tuple(tags)
+
+    def archive_paths(self, reference: str, paths: Iterable[str], directory) -> None:
+        """
+        Extract the given paths at the given reference into a directory
+        The working tree is not modified
+        """
+
+        # git archive errors on paths that don't exist, so only request files that do
+        # ls-tree doesn't expand wildcards, so list from the fixed part of each path and filter
+        paths = tuple(paths)
+        prefixes = {
+            "/".join(
+                itertools.takewhile(lambda part: not GLOB_CHARS_RE.search(part), path.split("/"))
+            )
+            or "."
+            for path in paths
+        }
+        files = [
+            path
+            for path in self.obj.git.ls_tree(
+                "-r", "-z", "--name-only", reference, "--", *sorted(prefixes)
+            ).split("\0")
+            if path and matches_paths(path, paths)
+        ]
+        if not files:
+            return
+
+        # Extraction filter is only available in newer Python releases
+        extract_kwargs = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+        # Stream the archive straight into extraction
+        # File names are exact, so keep git from treating them as patterns
+        process = self.obj.git(literal_pathspecs=True).archive(
+            reference, "--", *files, as_process=True
         )
+        with tarfile.open(fileobj=process.stdout, mode="r|") as tar:
+            tar.extractall(directory, **extract_kwargs)
+
+        # Drain any trailing padding so git can exit, then raise if it failed
+        process.stdout.read()
+        process.wait()
 
     def checkout(self, reference):
         """